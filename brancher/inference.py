@@ -4,7 +4,7 @@ Inference
 Module description
 """
 import warnings
-import copy
+import functools
 from abc import ABC, abstractmethod
 from collections.abc import Iterable
 
@@ -14,7 +14,8 @@ from tqdm import tqdm
 import torch
 
 from brancher.optimizers import ProbabilisticOptimizer
-from brancher.variables import Variable, ProbabilisticModel, Ensemble
+from brancher.modules import LossModule
+from brancher.variables import Variable, ProbabilisticModel, PosteriorModel, Ensemble
 from brancher.stochastic_processes import StochasticProcess
 from brancher.standard_variables import DeterministicVariable
 from brancher.transformations import truncate_model
@@ -33,12 +34,18 @@ def perform_inference(joint_model, number_iterations, number_samples = 1,
                       posterior_model=None,
                       sampler_model=None,
                       pretraining_iterations=0,
+                      jit_compile=False,
                       **opt_params): #TODO: input values
     """
     Summary
 
     Parameters
     ---------
+    jit_compile : bool
+        If True, the loss is traced with torch.jit after a first eager iteration and the traced
+        loss is used in the remaining iterations. Only valid for models with a static structure. The
+        traced loss is discarded if it does not reproduce the eager loss, and inference methods that
+        sample in Python (traceable_loss=False) are always run eagerly.
     """
     if isinstance(joint_model, StochasticProcess):
         posterior_submodel = joint_model.active_posterior_submodel
@@ -55,15 +62,9 @@ def perform_inference(joint_model, number_iterations, number_samples = 1,
         posterior_model = joint_model.posterior_model
     if posterior_model is None:
         posterior_model = inference_method.construct_posterior_model(joint_model)
-    if not sampler_model: #TODO: clean up
-        if not sampler_model:
-            try:
-                sampler_model = inference_method.sampler_model
-            except AttributeError:
-                try:
-                    sampler_model = joint_model.posterior_sampler
-                except AttributeError:
-                    sampler_model = None
+    sampler_model = (sampler_model
+                     or getattr(inference_method, "sampler_model", None)
+                     or getattr(joint_model, "posterior_sampler", None))
 
     joint_model.update_observed_submodel()
 
@@ -84,21 +85,55 @@ def perform_inference(joint_model, number_iterations, number_samples = 1,
 
     inference_method.check_model_compatibility(joint_model, posterior_model, sampler_model)
 
-    for iteration in tqdm(range(number_iterations)):
-        loss = inference_method.compute_loss(joint_model, posterior_model, sampler_model, number_samples)
-
-        if torch.isfinite(loss.detach()).all().item():
-            [opt.zero_grad() for opt in optimizers_list]
-            loss.backward()
-            inference_method.correct_gradient(joint_model, posterior_model, sampler_model, number_samples)
-            optimizers_list[0].update()
-            if iteration > pretraining_iterations:
-                [opt.update() for opt in optimizers_list[1:]]
-            loss_list.append(loss.cpu().detach().numpy().flatten())
-        else:
-            warnings.warn("Numerical error, skipping sample")
-        loss_list.append(loss.cpu().detach().numpy())
-    joint_model.diagnostics.update({"loss curve": np.array(loss_list)})
+    if jit_compile and not getattr(inference_method, "traceable_loss", False):
+        warnings.warn("The loss of {} cannot be traced, using eager execution instead".format(
+            type(inference_method).__name__))
+        jit_compile = False
+
+    loss_function = functools.partial(inference_method.compute_loss,
+                                      joint_model, posterior_model, sampler_model, number_samples)
+
+    finite_flags = []
+
+    def inference_step(loss_function, updated_optimizers):
+        loss = loss_function()
+        finite_loss = torch.isfinite(loss.detach()).all()
+        for opt in optimizers_list:
+            opt.zero_grad(set_to_none=True)
+        torch.where(finite_loss, loss, torch.zeros_like(loss)).backward()
+        for opt in optimizers_list:
+            opt.mask_grad(finite_loss)
+        inference_method.correct_gradient(joint_model, posterior_model, sampler_model, number_samples)
+        for opt in updated_optimizers:
+            opt.update()
+        return loss.detach(), finite_loss
+
+    def check_numerical_errors():
+        if finite_flags:
+            number_errors = int((~torch.stack(finite_flags)).sum())
+            if number_errors:
+                warnings.warn("Numerical error in {} of the last {} iterations, "
+                              "their gradients were set to zero".format(number_errors, len(finite_flags)))
+            finite_flags.clear()
+
+    number_pretraining_iterations = max(0, min(pretraining_iterations, number_iterations))
+    phases = [(optimizers_list[:1], number_pretraining_iterations),
+              (optimizers_list, number_iterations - number_pretraining_iterations)]
+    progress_bar = tqdm(total=number_iterations, mininterval=0.5, miniters=max(1, number_iterations//100))
+    for updated_optimizers, phase_iterations in phases:
+        for _ in range(phase_iterations):
+            loss, finite_loss = inference_step(loss_function, updated_optimizers)
+            if jit_compile and not loss_list:
+                loss_function = trace_loss_function(loss_function, optimizers_list)
+            finite_flags.append(finite_loss)
+            loss_list.append(loss)
+            if len(finite_flags) == 100:
+                check_numerical_errors()
+            progress_bar.update()
+    progress_bar.close()
+    check_numerical_errors()
+    loss_curve = torch.stack(loss_list).cpu().numpy().flatten() if loss_list else np.array([])
+    joint_model.diagnostics.update({"loss curve": loss_curve})
 
     inference_method.post_process(joint_model) #TODO: this could be implemented with a with block
 
@@ -106,6 +141,53 @@ def perform_inference(joint_model, number_iterations, number_samples = 1,
         inference_method.set_posterior_model_after_inference(joint_model, posterior_model, sampler_model)
 
 
+def trace_loss_function(loss_function, optimizers_list):
+    """
+    Summary
+
+    Parameters
+    ---------
+    loss_function : callable
+        Loss closure without arguments
+    optimizers_list : list of ProbabilisticOptimizer
+        Optimizers holding the parameters of the loss
+    """
+    loss_module = LossModule(loss_function, [opt.module for opt in optimizers_list])
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter("always", category=torch.jit.TracerWarning)
+        try:
+            traced_loss = torch.jit.trace(loss_module, (), check_trace=False)
+        except RuntimeError as error:
+            traced_loss = None
+            tracing_error = error
+    tracer_messages = []
+    for caught_warning in caught_warnings:
+        if issubclass(caught_warning.category, torch.jit.TracerWarning):
+            tracer_messages.append(str(caught_warning.message).split("\n")[0])
+        else:
+            warnings.warn_explicit(caught_warning.message, caught_warning.category,
+                                   caught_warning.filename, caught_warning.lineno)
+    if traced_loss is None:
+        warnings.warn("The loss could not be traced, using eager execution instead: {}".format(tracing_error))
+        return loss_function
+    if tracer_messages:
+        warnings.warn("Tracing the loss produced {} TracerWarnings, values computed in Python were frozen "
+                      "into the trace: {}".format(len(tracer_messages), "; ".join(sorted(set(tracer_messages)))))
+
+    cuda_devices = [torch.cuda.current_device()] if torch.cuda.is_available() else []
+    with torch.no_grad():
+        loss_function()
+        with torch.random.fork_rng(devices=cuda_devices):
+            numpy_state = np.random.get_state()
+            eager_loss = loss_function()
+            np.random.set_state(numpy_state)
+        traced_value = traced_loss()
+    if not torch.allclose(eager_loss, traced_value, rtol=1e-4, atol=1e-6, equal_nan=True):
+        warnings.warn("The traced loss does not match the eager loss, using eager execution instead")
+        return loss_function
+    return traced_loss
+
+
 class InferenceMethod(ABC):
 
     @abstractmethod
@@ -131,6 +213,7 @@ class ReverseKL(InferenceMethod):
         self.learnable_model = True
         self.needs_sampler = False
         self.learnable_sampler = False
+        self.traceable_loss = True
         self.gradient_estimator = gradient_estimator
 
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
@@ -170,6 +253,7 @@ class WassersteinVariationalGradientDescent(InferenceMethod):
         self.learnable_model = False #TODO: to implement later
         self.needs_sampler = True
         self.learnable_sampler = True
+        self.traceable_loss = False
         self.biased = biased
         self.number_post_samples = number_post_samples
         if cost_function:
@@ -179,25 +263,25 @@ class WassersteinVariationalGradientDescent(InferenceMethod):
         if deviation_statistics:
             self.deviation_statistics = deviation_statistics
         else:
-            self.deviation_statistics = lambda lst: sum(lst)
+            self.deviation_statistics = lambda lst: torch.stack(lst).sum(0)
 
         def model_statistics(dic):
             num_samples = list(dic.values())[0].shape[0]
             reassigned_particles = [reassign_samples(p._get_sample(num_samples), source_model=p, target_model=dic)
                                     for p in particles]
 
-            statistics = [self.deviation_statistics([self.cost_function(value_pair[0].detach().cpu().numpy(),
-                                                                        value_pair[1].detach().cpu().numpy())
+            statistics = [self.deviation_statistics([self.cost_function(value_pair[0].detach(), value_pair[1].detach())
                                                      for var, value_pair in zip_dict(dic, p).items()])
                           for p in reassigned_particles]
-            return np.array(statistics).transpose()
+            return torch.stack(statistics).t()
 
-        truncation_rules = [lambda a, idx=index: True if (idx == np.argmin(a)) else False
+        truncation_rules = [lambda a, idx=index: a.argmin(dim=1) == idx
                             for index in range(len(particles))]
 
         self.sampler_model = [truncate_model(model=sampler,
                                              truncation_rule=rule,
-                                             model_statistics=model_statistics)
+                                             model_statistics=model_statistics,
+                                             vectorized_rule=True)
                               for sampler, rule in zip(variational_samplers, truncation_rules)]
 
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
@@ -207,10 +291,10 @@ class WassersteinVariationalGradientDescent(InferenceMethod):
         # TODO: check particles
 
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
-        sampler_loss = sum([-joint_model.estimate_log_model_evidence(number_samples=number_samples, posterior_model=subsampler,
-                                                                     method="ELBO", input_values=input_values,
-                                                                     for_gradient=True, gradient_estimator=self.gradient_estimator)
-                            for subsampler in sampler_model])
+        sampler_loss = torch.stack([-joint_model.estimate_log_model_evidence(number_samples=number_samples, posterior_model=subsampler,
+                                                                             method="ELBO", input_values=input_values,
+                                                                             for_gradient=True, gradient_estimator=self.gradient_estimator)
+                                    for subsampler in sampler_model]).sum(0)
         particle_loss = self.get_particle_loss(joint_model, posterior_model, sampler_model, number_samples,
                                                input_values)
         return sampler_loss + particle_loss
@@ -229,40 +313,41 @@ class WassersteinVariationalGradientDescent(InferenceMethod):
                                    for samples, sampler, particle in zip(samples_list, sampler_model, particle_list)]
         pair_list = [zip_dict(particle._get_sample(1), samples)
                      for particle, samples in zip(particle_list, reassigned_samples_list)]
+        batched_pairs = {}
+        for pairs in pair_list:
+            for var, value_pair in pairs.items():
+                particle_value, sample_value = torch.broadcast_tensors(value_pair[0], value_pair[1].detach())
+                batched_pairs.setdefault(var.name, ([], []))
+                batched_pairs[var.name][0].append(particle_value)
+                batched_pairs[var.name][1].append(sample_value)
+        deviations = self.deviation_statistics([self.cost_function(torch.cat(particle_values), torch.cat(sample_values))
+                                                for particle_values, sample_values in batched_pairs.values()])
         if not self.biased:
-            particle_loss = sum([torch.sum(to_tensor(w)*self.deviation_statistics([self.cost_function(value_pair[0], value_pair[1].detach()) #TODO: numpy()
-                                                                    for var, value_pair in particle.items()]))
-                                 for particle, w in zip(pair_list, importance_weights)])
+            particle_loss = torch.sum(torch.cat([to_tensor(w) for w in importance_weights])*deviations)
         else:
-            particle_loss = sum([torch.sum(self.deviation_statistics([self.cost_function(value_pair[0], value_pair[1].detach())
-                                                                      for var, value_pair in particle.items()]))
-                                 for particle in pair_list])
+            particle_loss = torch.sum(deviations)
         return particle_loss
 
     def correct_gradient(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
         pass
 
     def post_process(self, joint_model):
-        sample_list = [sampler._get_sample(self.number_post_samples, max_itr=1)
-                        for sampler in self.sampler_model]
-        log_weights = []
-        for sampler, s in zip(self.sampler_model, sample_list):
-            _, logZ = joint_model.get_importance_weights(q_samples=s,
+        def get_log_normalization(sampler):
+            samples = sampler._get_sample(self.number_post_samples, max_itr=1)
+            _, logZ = joint_model.get_importance_weights(q_samples=samples,
                                                          q_model=sampler,
                                                          for_gradient=False,
                                                          give_normalization=True)
-            log_weights.append(logZ)
-        log_weights = torch.Tensor(log_weights)
-        alpha = log_weights.max()
-        un_weights = (log_weights - alpha).exp()
-        self.weights = (un_weights/un_weights.sum()).detach()
-        print(1)
+            return logZ
+
+        with torch.no_grad():
+            log_weights = torch.stack([get_log_normalization(sampler) for sampler in self.sampler_model])
+            self.weights = torch.softmax(log_weights, dim=0).detach()
         #joint_model.set_posterior_model(Ensemble(self.sampler_model, self.weights)) #TODO: Work in progress
 
     def set_posterior_model_after_inference(self, joint_model, posterior_model, sampler_model):
-        j_models = [copy.copy(joint_model) for _ in posterior_model]
-        [j_model.set_posterior_model(p_model) for j_model, p_model in zip(j_models, sampler_model)]
-        joint_model.posterior_model = Ensemble(j_models, weights=self.weights)
+        posterior_components = [PosteriorModel(sampler, joint_model=joint_model) for sampler in sampler_model]
+        joint_model.posterior_model = Ensemble(posterior_components, weights=self.weights)
 
 class MaximumLikelihood(InferenceMethod):
 
@@ -271,6 +356,7 @@ class MaximumLikelihood(InferenceMethod):
         self.learnable_model = True
         self.needs_sampler = False
         self.learnable_sampler = False
+        self.traceable_loss = True
 
     def construct_posterior_model(self, joint_model):
         return None
@@ -280,7 +366,7 @@ class MaximumLikelihood(InferenceMethod):
         pass
 
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
-        empirical_samples = joint_model.observed_submodel._get_sample(1, observed=True)
+        empirical_samples = joint_model._get_observed_sample()
         loss = -joint_model.calculate_log_probability(empirical_samples, for_gradient=True)
         return loss.sum()
 
@@ -298,6 +384,7 @@ class MAP(InferenceMethod):
         self.learnable_model = True
         self.needs_sampler = False
         self.learnable_sampler = False
+        self.traceable_loss = True
 
     def construct_posterior_model(self, joint_model):
         test_sample = joint_model._get_sample(1, observed=False)
@@ -311,7 +398,7 @@ class MAP(InferenceMethod):
         assert all([isinstance(var, (RootVariable, DeterministicVariable)) for var in posterior_model.flatten()])
 
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
-        empirical_samples = joint_model.observed_submodel._get_sample(1, observed=True)
+        empirical_samples = joint_model._get_observed_sample()
         variable_values = reassign_samples(posterior_model._get_sample(1), source_model=posterior_model,
                                            target_model=joint_model)
         variable_values.update(empirical_samples)
@@ -332,9 +419,11 @@ class SteinVariationalGradientDescent(InferenceMethod): #TODO: work in progress
         self.learnable_model = False  # TODO: to implement later
         self.needs_sampler = False
         self.learnable_sampler = False
-        self.deviation = lambda x, y: np.sum(((to_tensor(x) - to_tensor(y))**2).detach().numpy())
-        self.kernel = lambda d, bw: np.exp(-d/(2*bw))
+        self.traceable_loss = True
+        self.deviation = lambda x, y: ((x - y)**2).sum(-1)
+        self.kernel = lambda d, bw: torch.exp(-d/(2*bw))
         self.bandwidth = 0.01
+        self._schema = None
 
     def check_model_compatibility(self, joint_model, posterior_model, sampler_model):
         # TODO: Check differentiability of the model
@@ -342,38 +431,52 @@ class SteinVariationalGradientDescent(InferenceMethod): #TODO: work in progress
         pass
 
     def compute_loss(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
-        empirical_samples = joint_model.observed_submodel._get_sample(1, observed=True)
+        empirical_samples = joint_model._get_observed_sample()
         particle_samples = [reassign_samples(particle._get_sample(1), source_model=particle, target_model=joint_model)
                             for particle in posterior_model]
         [sample.update(empirical_samples) for sample in particle_samples]
-        loss = sum([-joint_model.calculate_log_probability(sample, for_gradient=True)
-                    for sample in particle_samples])
+        loss = torch.stack([-joint_model.calculate_log_probability(sample, for_gradient=True)
+                            for sample in particle_samples]).sum(0)
         return loss
 
     def correct_gradient(self, joint_model, posterior_model, sampler_model, number_samples, input_values={}):
-        self.update_bandwidth(posterior_model)
-        gradients = [[variable.value.grad for variable in particle.flatten()] for particle in posterior_model]
-        kernel_matrix = [[self.kernel(sum([self.deviation(variable1.value, variable2.value)
-                                          for variable1, variable2 in zip(particle1.flatten(), particle2.flatten())]),
-                                      bw=self.bandwidth)
-                          for particle1 in posterior_model] for particle2 in posterior_model]
-        interaction_matrix = [[[-(variable1.value - variable2.value)*kernel_matrix[particle_index1][particle_index2]/self.bandwidth
-                               for variable1, variable2 in zip(particle1.flatten(), particle2.flatten())]
-                              for particle_index1, particle1 in enumerate(posterior_model)]
-                              for particle_index2, particle2 in enumerate(posterior_model)]
-        for particle_index, particle in enumerate(posterior_model):
-            for variable_index, variable in enumerate(particle.flatten()):
-                variable.value.grad = sum([kernel_matrix[particle_index][other_index]*other_gradient[variable_index] + interaction_matrix[particle_index][other_index][variable_index]
-                                           for other_index, other_gradient in enumerate(gradients)])
-
-    def update_bandwidth(self, posterior_model):
-        distances = [np.sqrt(sum([self.deviation(variable1.value, variable2.value)
-                                  for variable1, variable2 in zip(particle1.flatten(), particle2.flatten())]))
-                     for particle1 in posterior_model
-                     for particle2 in posterior_model
-                     if particle1 is not particle2]
-        bw = 2*np.median(distances)**2/np.log(len(posterior_model))
-        self.bandwidth = bw
+        particle_variables = [sorted(particle.flatten(), key=lambda variable: variable.name)
+                              for particle in posterior_model]
+        if self._schema is None or particle_variables != self._particle_variables:
+            self._build_schema(particle_variables)
+        for particle_index, variables in enumerate(self._particle_variables):
+            for variable, (_, start, end, _) in zip(variables, self._schema):
+                self._flat_values[particle_index, start:end] = variable.value.detach().reshape(-1)
+                self._flat_gradients[particle_index, start:end] = variable.value.grad.reshape(-1)
+        particle_values = self._flat_values
+        squared_distances = self.deviation(particle_values.unsqueeze(1), particle_values.unsqueeze(0))
+        self.update_bandwidth(squared_distances)
+        kernel_matrix = self.kernel(squared_distances, bw=self.bandwidth)
+        differences = particle_values.unsqueeze(0) - particle_values.unsqueeze(1)
+        interaction_matrix = -(kernel_matrix.unsqueeze(2)*differences).sum(1)/self.bandwidth
+        corrected_gradients = torch.matmul(kernel_matrix, self._flat_gradients) + interaction_matrix
+        for variables, corrected_gradient in zip(self._particle_variables, corrected_gradients):
+            for variable, (_, start, end, shape) in zip(variables, self._schema):
+                variable.value.grad = corrected_gradient[start:end].reshape(shape)
+
+    def _build_schema(self, particle_variables):
+        self._particle_variables = particle_variables
+        self._schema = []
+        start = 0
+        for variable in self._particle_variables[0]:
+            end = start + variable.value.numel()
+            self._schema.append((variable.name, start, end, variable.value.shape))
+            start = end
+        reference_value = self._particle_variables[0][0].value
+        self._flat_values = torch.empty((len(particle_variables), start),
+                                        dtype=reference_value.dtype, device=reference_value.device)
+        self._flat_gradients = torch.empty_like(self._flat_values)
+
+    def update_bandwidth(self, squared_distances):
+        number_particles = squared_distances.shape[0]
+        rows, columns = torch.triu_indices(number_particles, number_particles, offset=1)
+        distances = torch.sqrt(squared_distances[rows, columns])
+        self.bandwidth = 2*torch.quantile(distances, 0.5)**2/np.log(number_particles)
 
     def post_process(self, joint_model):
         pass
@@ -17,6 +17,19 @@ class ParameterModule(nn.Module):
     def __call__(self, *args, **kwargs):
         return self.parameter
 
+class LossModule(nn.Module):
+    """
+    Wraps a loss closure together with the modules holding its parameters, so that the parameters
+    are registered as module attributes (and not as constants) when the closure is traced.
+    """
+    def __init__(self, loss_function, modules):
+        super(LossModule, self).__init__()
+        self.loss_function = loss_function
+        self.links = nn.ModuleList(modules)
+
+    def forward(self):
+        return self.loss_function()
+
 class EmptyModule(nn.ModuleList):
     """
     Summary
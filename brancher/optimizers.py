@@ -69,5 +69,14 @@ class ProbabilisticOptimizer(ABC):
     def update(self):
         self.optimizer.step()
 
-    def zero_grad(self):
-        self.optimizer.zero_grad()
+    def zero_grad(self, set_to_none=True):
+        self.optimizer.zero_grad(set_to_none=set_to_none)
+
+    def mask_grad(self, keep):
+        """
+        Sets the gradients to zero unless keep is True. keep is a boolean tensor so that the decision
+        stays on the device.
+        """
+        for parameter in self.module.parameters():
+            if parameter.grad is not None:
+                parameter.grad.masked_fill_(~keep, 0.)
@@ -7,7 +7,7 @@ from brancher.utilities import concatenate_samples, reject_samples
 from brancher.utilities import is_tensor
 
 
-def truncate_model(model, truncation_rule, model_statistics):
+def truncate_model(model, truncation_rule, model_statistics, vectorized_rule=False):
 
     def truncated_calculate_log_probability(rv_values, for_gradient=False, normalized=True):
         unnormalized_log_probability = model.calculate_log_probability(rv_values, normalized=normalized,
@@ -33,7 +33,8 @@ def truncate_model(model, truncation_rule, model_statistics):
         while (current_number_samples < number_samples and itr < max_itr) or current_number_samples < 1:
             remaining_samples, n, p = reject_samples(model._get_sample(batch_size, **kwargs),
                                                      model_statistics=model_statistics,
-                                                     truncation_rule=truncation_rule)
+                                                     truncation_rule=truncation_rule,
+                                                     vectorized_rule=vectorized_rule)
             if remaining_samples:
                 remaining_samples = {var: value[:number_samples - current_number_samples, :]
                                      for var, value in remaining_samples.items()}
@@ -47,7 +48,8 @@ def truncate_model(model, truncation_rule, model_statistics):
             samples = model._get_sample(number_samples)
         _, _, p = reject_samples(samples,
                                  model_statistics=model_statistics,
-                                 truncation_rule=truncation_rule)
+                                 truncation_rule=truncation_rule,
+                                 vectorized_rule=vectorized_rule)
         return p
 
     truncated_model = copy.copy(model)
@@ -293,12 +293,22 @@ def get_model_mapping(source_model, target_model):
     return model_mapping
 
 
+def get_cached_model_mapping(source_model, target_model):
+    cache = getattr(source_model, "_model_mapping_cache", None)
+    target_version = getattr(target_model, "_structure_version", None)
+    if cache is None or target_version is None:
+        return get_model_mapping(source_model, target_model)
+    if target_version not in cache:
+        cache[target_version] = get_model_mapping(source_model, target_model)
+    return cache[target_version]
+
+
 def reassign_samples(samples, model_mapping=(), source_model=(), target_model=()):
     out_sample = {}
     if model_mapping:
         pass
     elif source_model and target_model:
-        model_mapping = get_model_mapping(source_model, target_model)
+        model_mapping = get_cached_model_mapping(source_model, target_model)
     else:
         raise ValueError("Either a model mapping or both source and target models have to be provided as input")
     for key, value in samples.items():
@@ -309,9 +319,12 @@ def reassign_samples(samples, model_mapping=(), source_model=(), target_model=()
     return out_sample
 
 
-def reject_samples(samples, model_statistics, truncation_rule):
+def reject_samples(samples, model_statistics, truncation_rule, vectorized_rule=False):
     decision_variable = model_statistics(samples)
-    sample_indices = [index for index, value in enumerate(decision_variable) if truncation_rule(value)]
+    if vectorized_rule:
+        sample_indices = torch.nonzero(torch.as_tensor(truncation_rule(decision_variable))).flatten()
+    else:
+        sample_indices = [index for index, value in enumerate(decision_variable) if truncation_rule(value)]
     num_accepted_samples = len(sample_indices)
     if num_accepted_samples == 0:
         return None, 0, 0.001 #TODO: Improve
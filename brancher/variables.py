@@ -9,6 +9,7 @@ from abc import ABC, abstractmethod
 import operator
 import numbers
 import collections
+import itertools
 from collections.abc import Iterable
 
 from brancher.modules import ParameterModule
@@ -879,6 +880,9 @@ class RandomVariable(Variable):
         return repr
 
 
+_model_structure_versions = itertools.count()
+
+
 class ProbabilisticModel(BrancherClass):
     """
     ProbabilisticModels are collections of Brancher variables.
@@ -895,6 +899,7 @@ class ProbabilisticModel(BrancherClass):
         self.is_transformed = False
         self.diagnostics = {}
         self._fully_observed = is_fully_observed
+        self._observed_sample = None
         self._initialize_model(variables)
 
     def _initialize_model(self, variables):
@@ -908,6 +913,8 @@ class ProbabilisticModel(BrancherClass):
             None.
         """
         self._input_variables = self._validate_variables(variables)
+        self._structure_version = next(_model_structure_versions)
+        self._model_mapping_cache = {}
         self._set_summary()
         self.variables = self.flatten()
         if not all([var.is_latent for var in self._input_variables]):
@@ -1060,6 +1067,27 @@ class ProbabilisticModel(BrancherClass):
         flattened_model = self._flatten()
         observed_variables = [var for var in flattened_model if var.is_observed]
         self.observed_submodel = ProbabilisticModel(observed_variables, is_fully_observed=True)
+        self._observed_sample = None
+
+    def _get_observed_sample(self, differentiable=True):
+        """
+        Private method. It returns a sample of the observed submodel. The sample is cached when all the observed
+        variables have a fixed observed value and it is reused as long as those observed values are unchanged.
+
+        Args:
+            differentiable: Bool. Set to True if this function is used for differentiation.
+
+        Returns:
+            Dictionary(brancher.Variable: torch.Tensor). A dictionary of samples from the observed variables.
+        """
+        observed_variables = self.observed_submodel._input_variables
+        has_fixed_values = all([getattr(var, "has_observed_value", False) for var in observed_variables])
+        if (has_fixed_values and self._observed_sample is not None and
+                all([self._observed_sample.get(var) is var._observed_value for var in observed_variables])):
+            return dict(self._observed_sample)
+        observed_sample = self.observed_submodel._get_sample(1, observed=True, differentiable=differentiable)
+        self._observed_sample = observed_sample if has_fixed_values else None
+        return dict(observed_sample)
 
     def update_latent_submodel(self):
         flattened_model = self._flatten()
@@ -1410,7 +1438,7 @@ class ProbabilisticModel(BrancherClass):
             np.ndarray: Normalized weights for each sample of the q_model given this model.
         """
         if not empirical_samples:
-            empirical_samples = self.observed_submodel._get_sample(1, observed=True, differentiable=False)
+            empirical_samples = self._get_observed_sample(differentiable=False)
         q_log_prob = q_model.calculate_log_probability(q_samples,
                                                        for_gradient=for_gradient, normalized=False)
         p_log_prob = self.get_p_log_probabilities_from_q_samples(q_samples=q_samples,
@@ -1454,7 +1482,7 @@ class ProbabilisticModel(BrancherClass):
             self.check_posterior_model()
             posterior_model = self.posterior_model
         if method == "ELBO":
-            empirical_samples = self.observed_submodel._get_sample(1, observed=True, differentiable=False) #TODO Important!!: You need to correct for subsampling
+            empirical_samples = self._get_observed_sample(differentiable=False) #TODO Important!!: You need to correct for subsampling
             if for_gradient:
                 function = lambda samples: self.get_p_log_probabilities_from_q_samples(q_samples=samples,
                                                                                        empirical_samples=empirical_samples,
@@ -1674,11 +1702,20 @@ class Ensemble(BrancherClass):
 
     def estimate_log_model_evidence(self, number_samples, method="ELBO", input_values={},
                                     for_gradient=False, posterior_model=(), gradient_estimator=None):
-        return sum([weight*model.estimate_log_model_evidence(number_samples,
-                                                             method=method, input_values=input_values,
-                                                             for_gradient=for_gradient, posterior_model=posterior_model,
-                                                             gradient_estimator=gradient_estimator)
-                    for model, weight in zip(self.model_list, self.weights)])
+        """
+        Method. Estimates the weighted log-model evidence of the models in the ensemble. Models that are
+        PosteriorModels are evaluated as posterior models of their joint model.
+        """
+        def get_evidence(model):
+            if isinstance(model, PosteriorModel) and not posterior_model:
+                model, model_posterior = model.joint_model, model
+            else:
+                model_posterior = posterior_model
+            return model.estimate_log_model_evidence(number_samples,
+                                                     method=method, input_values=input_values,
+                                                     for_gradient=for_gradient, posterior_model=model_posterior,
+                                                     gradient_estimator=gradient_estimator)
+        return sum([weight*get_evidence(model) for model, weight in zip(self.model_list, self.weights)])
 
     def _get_statistic(self, query, input_values):
         raise NotImplemented
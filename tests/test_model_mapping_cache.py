@@ -0,0 +1,36 @@
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable
+from brancher.utilities import reassign_samples
+
+
+def test_target_model_gains_variables():
+    a = NormalVariable(0., 1., "a")
+    joint_model = ProbabilisticModel([a])
+    Qa = NormalVariable(0., 1., "a", learnable=True)
+    Qb = NormalVariable(0., 1., "b", learnable=True)
+    posterior_model = ProbabilisticModel([Qa, Qb])
+
+    samples = posterior_model._get_sample(2)
+    reassigned_samples = reassign_samples(samples, source_model=posterior_model, target_model=joint_model)
+    assert a in reassigned_samples and "b" not in [var.name for var in reassigned_samples]
+
+    b = NormalVariable(a, 1., "b")
+    joint_model.add_variables([b])
+    reassigned_samples = reassign_samples(samples, source_model=posterior_model, target_model=joint_model)
+    assert a in reassigned_samples and b in reassigned_samples
+    assert reassigned_samples[b] is samples[Qb]
+
+
+def test_source_model_gains_variables():
+    a = NormalVariable(0., 1., "a")
+    b = NormalVariable(a, 1., "b")
+    joint_model = ProbabilisticModel([a, b])
+    Qa = NormalVariable(0., 1., "a", learnable=True)
+    posterior_model = ProbabilisticModel([Qa])
+    reassign_samples(posterior_model._get_sample(2), source_model=posterior_model, target_model=joint_model)
+
+    Qb = NormalVariable(0., 1., "b", learnable=True)
+    posterior_model.add_variables([Qb])
+    samples = posterior_model._get_sample(2)
+    reassigned_samples = reassign_samples(samples, source_model=posterior_model, target_model=joint_model)
+    assert a in reassigned_samples and b in reassigned_samples
@@ -0,0 +1,47 @@
+import numpy as np
+import torch
+
+from brancher.variables import ProbabilisticModel
+from brancher.standard_variables import NormalVariable
+from brancher import inference
+
+
+def get_loss(model, seed):
+    torch.manual_seed(seed)
+    loss = inference.ReverseKL().compute_loss(model, model.posterior_model, None, 20)
+    return loss.item()
+
+
+def test_reobserved_data_is_used():
+    # Model
+    mu = NormalVariable(0., 10., "mu")
+    x = NormalVariable(mu, 1., "x")
+    model = ProbabilisticModel([x])
+    x.observe(np.random.normal(-2., 1., (10, 1)))
+
+    # Variational model
+    Qmu = NormalVariable(0., 1., "mu", learnable=True)
+    model.set_posterior_model(ProbabilisticModel([Qmu]))
+    inference.perform_inference(model, number_iterations=5, number_samples=5,
+                                inference_method=inference.ReverseKL(), optimizer="Adam", lr=0.01)
+
+    # Re-observe
+    new_data = 100*np.ones((10, 1))
+    x.observe(new_data)
+    reobserved_loss = get_loss(model, seed=1)
+    assert np.allclose(model._get_observed_sample()[x].detach().numpy().flatten(), new_data.flatten())
+
+    model.update_observed_submodel()
+    assert np.isclose(reobserved_loss, get_loss(model, seed=1))
+
+
+def test_fixed_observation_is_reused():
+    mu = NormalVariable(0., 10., "mu")
+    x = NormalVariable(mu, 1., "x")
+    model = ProbabilisticModel([x])
+    x.observe(np.random.normal(-2., 1., (10, 1)))
+    model.update_observed_submodel()
+
+    first_sample = model._get_observed_sample()
+    second_sample = model._get_observed_sample()
+    assert first_sample[x] is second_sample[x]
@@ -0,0 +1,66 @@
+import numpy as np
+import torch
+
+from brancher.variables import ProbabilisticModel, RootVariable
+from brancher import inference
+
+
+def get_particle(seed, shapes):
+    state = np.random.RandomState(seed)
+    return ProbabilisticModel([RootVariable(state.normal(size=shape), name=name, learnable=True)
+                               for name, shape in shapes.items()])
+
+
+def set_gradients(particles, seed):
+    generator = torch.Generator().manual_seed(seed)
+    for particle in particles:
+        for variable in particle.flatten():
+            variable.value.grad = torch.randn(variable.value.shape, generator=generator, dtype=variable.value.dtype)
+
+
+def reference_gradients(particles, gradients):
+    variables = [sorted(particle.flatten(), key=lambda variable: variable.name) for particle in particles]
+    values = [[variable.value.detach() for variable in particle_variables] for particle_variables in variables]
+    distances = [[np.sqrt(sum([float(((value1 - value2)**2).sum()) for value1, value2 in zip(values1, values2)]))
+                  for values1 in values] for values2 in values]
+    bandwidth = 2*np.median([distances[i][j] for i in range(len(particles))
+                             for j in range(len(particles)) if i != j])**2/np.log(len(particles))
+    kernel_matrix = [[np.exp(-distances[i][j]**2/(2*bandwidth)) for i in range(len(particles))]
+                     for j in range(len(particles))]
+    return [[sum([kernel_matrix[i][j]*gradients[j][k] - (values[j][k] - values[i][k])*kernel_matrix[i][j]/bandwidth
+                  for j in range(len(particles))])
+             for k in range(len(values[i]))]
+            for i in range(len(particles))]
+
+
+def test_multivariable_particles():
+    shapes = {"w": (2, 3), "b": (3,), "s": (1,)}
+    particles = [get_particle(seed, shapes) for seed in range(4)]
+    set_gradients(particles, seed=0)
+    gradients = [[variable.value.grad.clone() for variable in sorted(particle.flatten(), key=lambda variable: variable.name)]
+                 for particle in particles]
+    expected_gradients = reference_gradients(particles, gradients)
+
+    inference.SteinVariationalGradientDescent().correct_gradient(None, particles, None, 1)
+    for particle, expected_gradient in zip(particles, expected_gradients):
+        for variable, expected in zip(sorted(particle.flatten(), key=lambda variable: variable.name), expected_gradient):
+            assert torch.allclose(variable.value.grad, expected, rtol=1e-4, atol=1e-6)
+
+
+def test_particle_list_mutated_in_place():
+    shapes = {"w": (2,)}
+    particles = [get_particle(seed, shapes) for seed in range(3)]
+    svgd = inference.SteinVariationalGradientDescent()
+    set_gradients(particles, seed=0)
+    svgd.correct_gradient(None, particles, None, 1)
+
+    particles.append(get_particle(3, shapes))
+    particles[0] = get_particle(4, shapes)
+    set_gradients(particles, seed=1)
+    svgd.correct_gradient(None, particles, None, 1)
+
+    fresh_particles = [get_particle(seed, shapes) for seed in (4, 1, 2, 3)]
+    set_gradients(fresh_particles, seed=1)
+    inference.SteinVariationalGradientDescent().correct_gradient(None, fresh_particles, None, 1)
+    for particle, fresh_particle in zip(particles, fresh_particles):
+        assert torch.allclose(list(particle.flatten())[0].value.grad, list(fresh_particle.flatten())[0].value.grad)
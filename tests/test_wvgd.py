@@ -0,0 +1,74 @@
+import numpy as np
+import torch
+
+from brancher.variables import ProbabilisticModel, RootVariable
+from brancher.standard_variables import NormalVariable
+from brancher.utilities import reassign_samples, zip_dict, to_tensor
+from brancher import inference
+
+
+def get_models():
+    theta = NormalVariable(0., 2., "theta")
+    phi = NormalVariable(0., 2., "phi")
+    x = NormalVariable(theta + phi, 0.5, "x")
+    joint_model = ProbabilisticModel([x, theta, phi])
+    x.observe(np.array([0.5, 1., 1.5]).reshape(3, 1))
+    locs = [-1., 1.]
+    particles = [ProbabilisticModel([RootVariable(loc, name="theta", learnable=True),
+                                     RootVariable(-loc, name="phi", learnable=True)]) for loc in locs]
+    samplers = [ProbabilisticModel([NormalVariable(loc, 0.5, name="theta", learnable=True),
+                                    NormalVariable(-loc, 0.5, name="phi", learnable=True)]) for loc in locs]
+    return joint_model, particles, samplers
+
+
+def reference_particle_loss(method, joint_model, particle_list, sampler_model, number_samples):
+    samples_list = [sampler._get_sample(number_samples, input_values={}, max_itr=1) for sampler in sampler_model]
+    if method.biased:
+        importance_weights = [1./number_samples for _ in sampler_model]
+    else:
+        importance_weights = [joint_model.get_importance_weights(q_samples=samples, q_model=sampler,
+                                                                 for_gradient=False).flatten()
+                              for samples, sampler in zip(samples_list, sampler_model)]
+    reassigned_samples_list = [reassign_samples(samples, source_model=sampler, target_model=particle)
+                               for samples, sampler, particle in zip(samples_list, sampler_model, particle_list)]
+    pair_list = [zip_dict(particle._get_sample(1), samples)
+                 for particle, samples in zip(particle_list, reassigned_samples_list)]
+    if not method.biased:
+        return sum([torch.sum(to_tensor(w)*sum([method.cost_function(value_pair[0], value_pair[1].detach())
+                                                for var, value_pair in particle.items()]))
+                    for particle, w in zip(pair_list, importance_weights)])
+    return sum([torch.sum(sum([method.cost_function(value_pair[0], value_pair[1].detach())
+                               for var, value_pair in particle.items()]))
+                for particle in pair_list])
+
+
+def get_loss_and_gradients(loss_function, biased):
+    joint_model, particles, samplers = get_models()
+    method = inference.WassersteinVariationalGradientDescent(variational_samplers=samplers, particles=particles,
+                                                             biased=biased)
+    torch.manual_seed(2)
+    np.random.seed(2)
+    loss = loss_function(method, joint_model, particles, method.sampler_model, 10)
+    loss.backward()
+    gradients = {(index, variable.name): variable.value.grad.clone()
+                 for index, particle in enumerate(particles) for variable in particle.flatten()}
+    return loss.detach(), gradients
+
+
+def check_particle_loss(biased):
+    def particle_loss(method, joint_model, particles, sampler_model, number_samples):
+        return method.get_particle_loss(joint_model, particles, sampler_model, number_samples, {})
+
+    loss, gradients = get_loss_and_gradients(particle_loss, biased)
+    reference_loss, reference_gradients = get_loss_and_gradients(reference_particle_loss, biased)
+    assert torch.allclose(loss, reference_loss, rtol=1e-5)
+    for key, gradient in gradients.items():
+        assert torch.allclose(gradient, reference_gradients[key], rtol=1e-5, atol=1e-7)
+
+
+def test_unbiased_particle_loss():
+    check_particle_loss(biased=False)
+
+
+def test_biased_particle_loss():
+    check_particle_loss(biased=True)